@@ -1,191 +1,290 @@
 # Importing the necessary libraries
-import requests
-import pandas as pd
+import httpx
+import numpy as np
 from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
-from langchain.memory import ChatMessageHistory
+from langchain.memory import ConversationSummaryBufferMemory
+from langchain.schema import AIMessage, HumanMessage, Generation
 from langchain.chat_models import ChatOpenAI
+from langchain.cache import SQLiteCache
 from datetime import datetime
-import math
+import asyncio
+import functools
+import time
+import hashlib
+import tempfile
+import orjson
+import csv
 import os
 from dotenv import load_dotenv
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from contextlib import asynccontextmanager
+from collections import OrderedDict
 load_dotenv()
 
 # Loading API key from environment variables
 API_KEY_OPEN_WEATHER = os.environ.get('OPEN_WEATHER_API_KEY', 'default_value')
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY', 'default_value')
 
-# Checking if CSV File Exists
-csv_file_path = 'Air Quality Table - LandR.csv'
-if os.path.exists(csv_file_path):
-    combined_levels_and_rec_df = pd.read_csv(csv_file_path)
-else:
-    print(f"Error: File {csv_file_path} not found.")
-    # Handle the error as needed, for example, by exiting the program
+def load_levels_and_recommendations(path):
+    """
+    Function to load the air quality levels and recommendations table into NumPy arrays.
+    
+    Parameters:
+    path (str): Path to the CSV file with the air quality levels and recommendations.
+    
+    Returns:
+    dict: A dictionary mapping each column name to a NumPy array of its values. Index and bounds 
+          are numeric, missing recommendations are None.
+    """
+    with open(path, newline='', encoding='utf-8') as csv_file:
+        reader = csv.reader(csv_file)
+        header = next(reader)
+        columns = list(zip(*reader))
+    
+    table = {}
+    for column_name, values in zip(header, columns):
+        if column_name == 'Index':
+            table[column_name] = np.array(values, dtype=np.int64)
+        elif column_name.endswith((' Lower', ' Upper')):
+            table[column_name] = np.array(values, dtype=np.float64)
+        else:
+            table[column_name] = np.array(
+                [None if value in ('', 'None') else value for value in values],
+                dtype=object
+            )
+    
+    return table
+
+# Checking if CSV File Exists; it is looked up next to this file, whatever the working directory
+csv_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Air Quality Table - LandR.csv')
+if not os.path.exists(csv_file_path):
+    raise FileNotFoundError(f"Error: File {csv_file_path} not found.")
+TABLE = load_levels_and_recommendations(csv_file_path)
+
+# Map API pollutant names to table column names
+pollutant_column_map = {
+    'co': 'CO',
+    'no2': 'NO2',
+    'o3': 'O3',
+    'so2': 'SO2',
+    'pm2_5': 'PM2.5',
+    'pm10': 'PM10'
+}
+
+# Lookup columns: the upper bounds of each pollutant are sorted,
+# so a value can be matched to its level row with np.searchsorted
+qual_names = TABLE['Qualitative Name']
+idx_vals = TABLE['Index']
+api_pollutants = np.array(list(pollutant_column_map))
+
+# One (api_pollutant, upper_edges, recommendations) triple per pollutant
+POLLUTANT_TABLES = tuple(
+    (api_pollutant, TABLE[f'{table_pollutant} Upper'], TABLE[f'{table_pollutant} Recommendations'])
+    for api_pollutant, table_pollutant in pollutant_column_map.items()
+)
 
 # Set up API and locations
-API_BASE_URL_OPEN_WEATHER = "http://api.openweathermap.org/data/2.5/air_pollution"
+API_BASE_URL_OPEN_WEATHER = "https://api.openweathermap.org/data/2.5/air_pollution"
 lat = 9.706497174
 lon = 99.985496058
 
-def get_current_air_pollution_data():
-    url = f"{API_BASE_URL_OPEN_WEATHER}?lat={lat}&lon={lon}&appid={API_KEY_OPEN_WEATHER}"
-    
+# HTTP/2 client for the OpenWeather API (needs the httpx[http2] extra). The response is
+# memoized per process, so this normally makes a single request; it is closed on shutdown
+SESSION = httpx.Client(http2=True, timeout=5.0)
+
+# Cache OpenWeather responses on disk; the upstream data only updates hourly.
+# On network errors the last cached response is served even if it has expired.
+AQ_CACHE_TTL = int(os.environ.get('AQ_CACHE_TTL', '900'))
+aq_cache_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'aq_cache.json')
+
+def get_cache_key(url):
+    # The URL holds the API key, so only its hash is written to disk
+    return hashlib.sha256(url.encode()).hexdigest()
+
+def load_cached_air_pollution_data(url, max_age):
+    """Return the cached response for url if it is at most max_age seconds old, otherwise None."""
     try:
-        response = requests.get(url)
-        response.raise_for_status()  # Raise HTTPError for bad responses (4xx and 5xx)
-        
-        data = response.json()
-        
-        if 'coord' in data and 'list' in data:
-            return data
-        else:
-            print(f"Error fetching data: {data}")
+        with open(aq_cache_path, 'rb') as cache_file:
+            cached = orjson.loads(cache_file.read())
+        if cached['key'] != get_cache_key(url) or time.time() - cached['fetched_at'] > max_age:
             return None
-    except requests.RequestException as e:
-        print(f"Request failed: {e}")
+        return cached['data']
+    except (OSError, ValueError, KeyError, TypeError):
         return None
 
-current_air_pollution_data = get_current_air_pollution_data()
+def save_cached_air_pollution_data(url, data):
+    # Write to a temporary file and swap it in, so concurrent readers never see a partial file
+    cache_dir = os.path.dirname(os.path.abspath(aq_cache_path))
+    with tempfile.NamedTemporaryFile('wb', dir=cache_dir, delete=False) as cache_file:
+        cache_file.write(orjson.dumps({'key': get_cache_key(url), 'fetched_at': time.time(), 'data': data}))
+    os.replace(cache_file.name, aq_cache_path)
+
+def is_valid_air_pollution_response(data):
+    """Return whether data has coordinates and data points that each carry a timestamp and every pollutant."""
+    if not isinstance(data, dict) or 'coord' not in data:
+        return False
+    
+    air_quality_data_list = data.get('list')
+    if not isinstance(air_quality_data_list, list) or not air_quality_data_list:
+        return False
+    
+    for data_point in air_quality_data_list:
+        if not isinstance(data_point, dict) or 'dt' not in data_point:
+            return False
+        components = data_point.get('components')
+        if not isinstance(components, dict) or not all(pollutant in components for pollutant in pollutant_column_map):
+            return False
+    return True
+
+@functools.lru_cache(maxsize=1)
+def get_current_air_pollution_data():
+    url = f"{API_BASE_URL_OPEN_WEATHER}?lat={lat}&lon={lon}&appid={API_KEY_OPEN_WEATHER}"
+    
+    cached_data = load_cached_air_pollution_data(url, AQ_CACHE_TTL)
+    if cached_data is not None:
+        return cached_data
+    
+    try:
+        response = SESSION.get(url)
+        response.raise_for_status()  # Raise HTTPStatusError for bad responses (4xx and 5xx)
+    except httpx.HTTPError as e:
+        # Fall back to the last cached response, however old
+        cached_data = load_cached_air_pollution_data(url, float('inf'))
+        if cached_data is None:
+            raise RuntimeError(f"Request failed: {e}") from e
+        print(f"Request failed, using cached data: {e}")
+        return cached_data
+    
+    try:
+        data = orjson.loads(response.content)
+    except orjson.JSONDecodeError:
+        raise RuntimeError(f"Malformed response: {response.text}") from None
+    
+    # Fail fast, before caching, on a response the level lookup could not use
+    if not is_valid_air_pollution_response(data):
+        raise RuntimeError(f"Malformed response: {data}")
+    
+    save_cached_air_pollution_data(url, data)
+    return data
 
-def get_pollutant_levels_and_recommendations(api_response, combined_df):
+def get_pollutant_levels_and_recommendations(api_response):
     """
     Function to match pollutant values from API response with air quality levels and recommendations.
     
     Parameters:
     api_response (dict): Dictionary containing the entire API response.
-    combined_df (DataFrame): DataFrame containing the combined air quality levels and recommendations table.
     
     Returns:
-    dict: A dictionary containing the qualitative name, index, and recommendation for each pollutant, 
-          along with the timestamp from the API response.
+    list: A list with one dictionary per data point, holding the timestamp from the API response and 
+          parallel arrays of the pollutant names and their qualitative name, index, and recommendation.
     """
     # Extract the list of air quality data from the API response
     air_quality_data_list = api_response['list']
     
-    # Initialize an empty list to store the levels and recommendations for each data point in the API response
-    results = []
-    
-    # Map API pollutant names to DataFrame column names
-    pollutant_column_map = {
-        'co': 'CO',
-        'no2': 'NO2',
-        'o3': 'O3',
-        'so2': 'SO2',
-        'pm2_5': 'PM2.5',
-        'pm10': 'PM10'
-    }
+    # Level row and recommendation for every data point (rows) and pollutant (columns)
+    level_rows = np.empty((len(air_quality_data_list), len(POLLUTANT_TABLES)), dtype=np.intp)
+    recommendations = np.empty(level_rows.shape, dtype=object)
     
-    # Iterate through each data point in the API response
-    for data_point in air_quality_data_list:
-        # Extract the pollutant concentrations and timestamp from the data point
-        components = data_point['components']
-        timestamp = data_point['dt']
-        
-        # Initialize an empty dictionary to store the levels and recommendations for this data point
-        pollutant_info = {'Timestamp': timestamp}
-        
-        # Iterate through each pollutant in the API response data
-        for api_pollutant, df_pollutant in pollutant_column_map.items():
-            # Get the value of the pollutant from the components data
-            value = components[api_pollutant]
-            
-            # Find the corresponding row in the combined_df DataFrame
-            level_and_rec_row = combined_df[
-                (combined_df[f'{df_pollutant} Lower'] <= value) & 
-                (combined_df[f'{df_pollutant} Upper'] >= value)
-            ].iloc[0]
-            
-            # Store the qualitative name, index, and recommendation for this pollutant in the dictionary
-            pollutant_info[api_pollutant] = {
-                'Qualitative Name': level_and_rec_row['Qualitative Name'],
-                'Index': level_and_rec_row['Index'],
-                'Recommendation': level_and_rec_row[f'{df_pollutant} Recommendations']
-            }
+    # Match all data points of one pollutant at once
+    for column, (api_pollutant, edges, recs) in enumerate(POLLUTANT_TABLES):
+        values = np.fromiter(
+            (data_point['components'][api_pollutant] for data_point in air_quality_data_list),
+            dtype=np.float64,
+            count=len(air_quality_data_list)
+        )
         
-        # Add the pollutant info for this data point to the results list
-        results.append(pollutant_info)
+        # First row whose upper bound is not below the value; values past the table fall into the last row
+        rows = np.searchsorted(edges, values, side='left')
+        level_rows[:, column] = np.minimum(rows, len(qual_names) - 1)
+        recommendations[:, column] = recs[level_rows[:, column]]
     
-    return results
-
-# Store the result of the function in a variable
-pollution_levels_and_recommendations = get_pollutant_levels_and_recommendations(current_air_pollution_data, combined_levels_and_rec_df)
+    return [
+        {
+            'Timestamp': data_point['dt'],
+            'Pollutant': api_pollutants,
+            'Qualitative Name': qual_names[point_rows],
+            'Index': idx_vals[point_rows],
+            'Recommendation': point_recs
+        }
+        for data_point, point_rows, point_recs in zip(air_quality_data_list, level_rows, recommendations)
+    ]
 
 def generate_message(pollution_levels_and_recommendations):
+    current_levels = pollution_levels_and_recommendations[0]
+    
     # Convert timestamp to local time
-    timestamp = pollution_levels_and_recommendations[0]['Timestamp']
+    timestamp = current_levels['Timestamp']
     local_time = datetime.fromtimestamp(timestamp)
     time_str = local_time.strftime('%H:%M %p on %d %B %Y')
     
     # Determine overall pollution level
-    max_index = -1
-    pollutant_levels = {}  # To store pollutant levels separately
-
-    for pollutant, data in pollution_levels_and_recommendations[0].items():
-        if pollutant != 'Timestamp':
-            pollutant_levels[pollutant] = data['Index']  # Extracting the Index value
-            if data['Index'] > max_index:
-                max_index = data['Index']
-                max_qualitative_name = data['Qualitative Name']
+    indices = current_levels['Index']
+    max_qualitative_name = current_levels['Qualitative Name'][indices.argmax()]
+    pollutant_levels = dict(zip(current_levels['Pollutant'].tolist(), indices.tolist()))
     
-    # Extract and combine recommendations into bullet points
-    recommendations_list = [f"- {data['Recommendation']}" for pollutant, data in pollution_levels_and_recommendations[0].items() if pollutant != 'Timestamp' and (not isinstance(data['Recommendation'], float) or (isinstance(data['Recommendation'], float) and not math.isnan(data['Recommendation'])))]
+    # Extract and combine recommendations into bullet points, skipping missing ones
+    recs = current_levels['Recommendation']
+    recommendations_list = '- ' + recs[np.not_equal(recs, None)]
 
     # Generate the final message with new formatting
     greetings = f"Citizens of Koh-Phangan!\nNow it is {time_str}, air condition is {max_qualitative_name.lower()}."
     recommendations = '\n'.join(recommendations_list)
     pollutant_levels = f"{pollutant_levels}"
     
-    return greetings, recommendations, pollutant_levels
-
-
-# Generate the message based on the current air pollution data
-greetings, recommendations, pollutant_levels = generate_message(pollution_levels_and_recommendations)
+    return greetings, recommendations, pollutant_levels, max_qualitative_name
 
 #Model version
 GPT3 = 'gpt-3.5-turbo-16k-0613'
 GPT4 = 'gpt-4-0613'
 
-chat_greetings_template = PromptTemplate(
-    input_variables=['greetings'],
-    template="""
-            You are an expert greeting people. Your task is to welcome people who are reading this message 
+# The two startup tasks; they are sent to GPT-4 together in a single batched prompt, or the
+# greeting alone when the recommendations answer is already cached
+GREETING_TASK = """You are an expert greeting people. Your task is to welcome people who are reading this message 
             with warm welcome. Use emojis in your response. 
             Say good day, good night, depending on a time. Inform about current date and time. Max message lenght is 30 words
-            Current conditions are {greetings}
-    """
-)
+            Current conditions are {greetings}"""
 
-recommendations_template = PromptTemplate(
-    input_variables=['recommendations'],
-    template="""
-            You are an expert in providing concise recommendations based on current air pollution levels 
+RECOMMENDATIONS_TASK = """You are an expert in providing concise recommendations based on current air pollution levels 
             and recommendations. Your goal is to provide recommendations data that you will receive in concise manner 
             keeping only meaning with minimal amount of text removing any repetetivness
             Start with: Based on air pollution recommendations are:
-            Current recommmendations are {recommendations}
+            Current recommmendations are {recommendations}"""
+
+GREETING_TEMPLATE = PromptTemplate(
+    input_variables=['greetings'],
+    template="""
+            """ + GREETING_TASK + """
     """
 )
 
-greet_llm = ChatOpenAI(temperature=1, model = GPT4, openai_api_key=OPENAI_API_KEY)
-recommendations_llm = ChatOpenAI(temperature=0, model = GPT4, openai_api_key=OPENAI_API_KEY)
-
-chat_greetings_chain = LLMChain(llm=greet_llm, prompt=chat_greetings_template, output_key='chat_greetinigs')
-chat_recommendations_chain = LLMChain(llm=recommendations_llm, prompt=recommendations_template, output_key='chat_recommendations')
-
-chat_greetings = chat_greetings_chain.run(greetings=greetings)
-chat_recommendations = chat_recommendations_chain.run(recommendations=recommendations)
+STARTUP_TEMPLATE = PromptTemplate(
+    input_variables=['greetings', 'recommendations'],
+    template="""
+            Complete the two tasks below.
 
-print(chat_greetings)
-print(chat_recommendations)
+            [1] """ + GREETING_TASK + """
 
-AirQualityBot = ChatOpenAI(temperature=0.1, model = GPT4)
+            [2] """ + RECOMMENDATIONS_TASK + """
 
-history = ChatMessageHistory()
+            Return JSON with keys greeting, recommendations holding the answers to [1] and [2], e.g.
+            {{"greeting": "...", "recommendations": "..."}}
+            Do not add any text outside the JSON.
+    """
+)
 
-start_message = f"{chat_greetings} {chat_recommendations}"
+# Model settings of the startup prompt; the cache entries are tagged with them and with the
+# recommendations task, so changing either starts a fresh cache
+STARTUP_MODEL = GPT4
+STARTUP_TEMPERATURE = 0.5
+STARTUP_LLM_STRING = (
+    f"{STARTUP_MODEL}:{STARTUP_TEMPERATURE}:"
+    + hashlib.sha256(RECOMMENDATIONS_TASK.encode()).hexdigest()
+)
+llm_cache_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.llm_cache.db')
 
-role = """
+ROLE = """
 
 Purpose:
 The AirQuality bot serves as an informational assistant providing current air quality updates and health 
@@ -221,29 +320,320 @@ The bot should not perform functions beyond providing air quality updates and
 associated health recommendations.
 """
 
-history.add_ai_message(role)
-history.add_ai_message(start_message)
+@functools.lru_cache(maxsize=None)
+def get_llm(model, temperature):
+    """Return a shared ChatOpenAI client for the given model and temperature."""
+    return ChatOpenAI(temperature=temperature, model = model, openai_api_key=OPENAI_API_KEY)
 
-print(history.messages)
+# Bound the number of concurrent OpenAI requests to stay within the account's rate limit.
+# The bound is per process: N processes sharing one account allow N * OPENAI_MAX_PARALLEL
+OPENAI_SEMAPHORE = asyncio.Semaphore(int(os.environ.get('OPENAI_MAX_PARALLEL', '8')))
 
+async def call_openai(func, *args, **kwargs):
+    """Await an OpenAI-bound call while holding one of the OPENAI_MAX_PARALLEL slots."""
+    async with OPENAI_SEMAPHORE:
+        return await func(*args, **kwargs)
 
-# Start the conversation loop.
-while True:
-    # Get user input.
-    user_input = input("User: ")
-
-    # Check if the user wants to end the conversation.
-    if user_input.lower() == 'quit':
-        break
-
-    # Add user message to the history.
-    history.add_user_message(user_input)
-
-    # Get AI response
-    ai_response = str(AirQualityBot(history.messages))
+def parse_startup_response(response):
+    """
+    Function to extract the greeting and recommendations from the reply to STARTUP_TEMPLATE.
+    
+    Parameters:
+    response (str): The model's reply, possibly wrapped in a code fence or surrounded by prose.
+    
+    Returns:
+    tuple: The greeting and recommendations, or None if the reply holds no JSON object with both keys.
+    """
+    start, end = response.find('{'), response.rfind('}')
+    if start == -1 or end < start:
+        return None
+    
+    try:
+        startup_messages = orjson.loads(response[start:end + 1])
+    except orjson.JSONDecodeError:
+        return None
+    
+    if not isinstance(startup_messages, dict):
+        return None
+    greeting = startup_messages.get('greeting')
+    recommendations = startup_messages.get('recommendations')
+    if not isinstance(greeting, str) or not isinstance(recommendations, str):
+        return None
+    return greeting, recommendations
 
-    # Add AI message to the history.
-    history.add_ai_message(ai_response)
+async def startup():
+    """
+    Function to fetch the current air pollution data and let GPT-4 write the greeting and recommendations.
+    
+    Returns:
+    list: The role and start messages that are sent ahead of every chat request.
+    """
+    # Generate the message based on the current air pollution data
+    current_air_pollution_data = get_current_air_pollution_data()
+    pollution_levels_and_recommendations = get_pollutant_levels_and_recommendations(current_air_pollution_data)
+    greetings, recommendations, pollutant_levels, max_qualitative_name = generate_message(pollution_levels_and_recommendations)
+
+    startup_llm = get_llm(STARTUP_MODEL, STARTUP_TEMPERATURE)
+
+    # Only the recommendations answer is cached. Its key leaves out the measurement time, so it is
+    # reused whenever the conditions repeat; the greeting mentions the time and is always asked for
+    startup_cache = SQLiteCache(database_path=llm_cache_path)
+    cache_key = f"{max_qualitative_name}\n{recommendations}"
+    cached_generations = startup_cache.lookup(cache_key, STARTUP_LLM_STRING)
+
+    if cached_generations:
+        chat_recommendations = cached_generations[0].text
+        greeting_prompt = GREETING_TEMPLATE.format(greetings=greetings)
+        chat_greetings = (await call_openai(startup_llm.ainvoke, greeting_prompt)).content.strip()
+    else:
+        startup_prompt = STARTUP_TEMPLATE.format(greetings=greetings, recommendations=recommendations)
+        response = (await call_openai(startup_llm.ainvoke, startup_prompt)).content
+
+        startup_messages = parse_startup_response(response)
+        if startup_messages is None:
+            # Show the reply as it is and leave it out of the cache, so the next start asks again
+            chat_greetings, chat_recommendations = response.strip(), ''
+        else:
+            chat_greetings, chat_recommendations = startup_messages
+            startup_cache.update(cache_key, STARTUP_LLM_STRING, [Generation(text=chat_recommendations)])
+
+    print(chat_greetings)
+    if chat_recommendations:
+        print(chat_recommendations)
+
+    start_message = f"{chat_greetings} {chat_recommendations}".strip()
+
+    # Role and start message are sent ahead of every request, so they are never summarised away
+    return [AIMessage(content=ROLE), AIMessage(content=start_message)]
+
+# Chat sessions, keyed by session id: each holds its memory and a lock that serialises its
+# turns. They are held in this process only, so the server runs as a single worker; once
+# AQ_MAX_SESSIONS sessions are held, the least recently used idle one is dropped
+MAX_SESSIONS = int(os.environ.get('AQ_MAX_SESSIONS', '1000'))
+sessions = OrderedDict()
+
+def get_session(session_id):
+    """Return the (memory, lock) of a session; the memory keeps only the last ~1.5k tokens of turns verbatim."""
+    if session_id in sessions:
+        sessions.move_to_end(session_id)
+    else:
+        # Older turns are rolled up into a running summary by the cheaper model
+        memory = ConversationSummaryBufferMemory(
+            llm=get_llm(GPT3, 0),
+            max_token_limit=1500,
+            return_messages=True
+        )
+        sessions[session_id] = (memory, asyncio.Lock())
+        if len(sessions) > MAX_SESSIONS:
+            evict_idle_session(keep=session_id)
+    return sessions[session_id]
+
+def evict_idle_session(keep):
+    # A session whose lock is held is answering a turn; dropping it would let the next request
+    # start a second, unserialised history. If every session is busy, the store stays over the cap.
+    for session_id, (_, lock) in sessions.items():
+        if session_id != keep and not lock.locked():
+            del sessions[session_id]
+            return
+
+# Micro-batching of chat requests: a background collector drains up to BATCH_MAX_SIZE
+# pending requests every BATCH_WINDOW seconds and sends them to the model together
+BATCH_MAX_SIZE = 16
+BATCH_WINDOW = 0.025
+pending_requests = None
+batcher_task = None
+batch_tasks = set()
+
+def fail_requests(batch, reason):
+    """Resolve every still-pending future of a batch with a RuntimeError."""
+    for _, future in batch:
+        if not future.done():
+            future.set_exception(RuntimeError(reason))
+
+def fail_pending_requests(reason):
+    """Fail every request still waiting in the queue."""
+    batch = []
+    while pending_requests is not None and not pending_requests.empty():
+        batch.append(pending_requests.get_nowait())
+    fail_requests(batch, reason)
+
+async def answer_batch(batch):
+    """Answer a batch of (messages, future) requests and resolve each future with its AI message."""
+    AirQualityBot = get_llm(GPT4, 0.1)
+
+    # The OpenAI chat API takes one conversation per request, so the batch is sent concurrently
+    try:
+        results = await asyncio.gather(
+            *(call_openai(AirQualityBot.ainvoke, messages) for messages, _ in batch),
+            return_exceptions=True
+        )
+    except asyncio.CancelledError:
+        fail_requests(batch, "Chat batch was cancelled")
+        raise
+
+    for (_, future), result in zip(batch, results):
+        if future.done():
+            continue
+        if isinstance(result, BaseException):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+async def run_batcher():
+    while True:
+        # Wait for the first request, then give others the batch window to arrive
+        batch = [await pending_requests.get()]
+        try:
+            await asyncio.sleep(BATCH_WINDOW)
+        except asyncio.CancelledError:
+            fail_requests(batch, "Chat batcher was stopped")
+            raise
+        while len(batch) < BATCH_MAX_SIZE and not pending_requests.empty():
+            batch.append(pending_requests.get_nowait())
+
+        # Answer the batch in the background so the next one can be collected meanwhile
+        task = asyncio.create_task(answer_batch(batch))
+        batch_tasks.add(task)
+        task.add_done_callback(batch_tasks.discard)
+
+async def invoke_batched(messages):
+    """Queue a conversation for the next batch and wait for its AI message."""
+    global pending_requests, batcher_task
+    if batcher_task is None or batcher_task.done():
+        # Requests left in the queue of a stopped collector would never be answered
+        fail_pending_requests("Chat batcher was stopped")
+        pending_requests = asyncio.Queue()
+        batcher_task = asyncio.create_task(run_batcher())
+
+    future = asyncio.get_running_loop().create_future()
+    await pending_requests.put((messages, future))
+    return await future
+
+async def stop_batcher():
+    """Stop the collector and its batches, failing every request that is still waiting."""
+    tasks = list(batch_tasks)
+    if batcher_task is not None:
+        tasks.append(batcher_task)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    fail_pending_requests("Chat server is shutting down")
+
+def build_messages(user_input, memory, context_messages):
+    """Return the context, the summary of older turns, the recent turns and the new user message."""
+    return context_messages + memory.load_memory_variables({})['history'] + [HumanMessage(content=user_input)]
+
+async def save_turn(user_input, ai_response, memory):
+    # Add the turn to the memory
+    memory.chat_memory.add_user_message(user_input)
+    memory.chat_memory.add_ai_message(ai_response)
+
+    # Pruning only calls the summariser once the buffer exceeds max_token_limit, so only then
+    # does it take an OpenAI slot; it runs off the event loop
+    if memory.llm.get_num_tokens_from_messages(memory.chat_memory.messages) > memory.max_token_limit:
+        await call_openai(asyncio.to_thread, memory.prune)
+
+async def chat(user_input, session, context_messages):
+    """Answer one user message; awaiting OpenAI lets other sessions proceed meanwhile."""
+    memory, lock = session
+
+    # A session answers one turn at a time, so each turn sees and extends the previous one
+    async with lock:
+        messages = build_messages(user_input, memory, context_messages)
+
+        # Get AI response; only its text goes back into the memory
+        ai_message = await invoke_batched(messages)
+        ai_response = ai_message.content
+
+        await save_turn(user_input, ai_response, memory)
+
+    return ai_response
+
+async def stream_chat(user_input, session, context_messages):
+    """Answer one user message, yielding the reply text as it is generated."""
+    AirQualityBot = get_llm(GPT4, 0.1)
+    memory, lock = session
+
+    # A session answers one turn at a time, so each turn sees and extends the previous one
+    async with lock:
+        messages = build_messages(user_input, memory, context_messages)
+
+        # Read the AI response in a task that holds the OpenAI slot only while OpenAI is streaming,
+        # so a slow reader of this generator does not keep the slot from other requests
+        chunks = asyncio.Queue()
+
+        async def read_stream():
+            try:
+                async with OPENAI_SEMAPHORE:
+                    async for chunk in AirQualityBot.astream(messages):
+                        chunks.put_nowait(chunk.content)
+            finally:
+                chunks.put_nowait(None)
+
+        reader = asyncio.create_task(read_stream())
+        ai_chunks = []
+        try:
+            while (chunk := await chunks.get()) is not None:
+                ai_chunks.append(chunk)
+                yield chunk
+        finally:
+            # Stop reading from OpenAI if the caller stops listening
+            reader.cancel()
+
+        # Re-raise an error of the upstream stream instead of saving a partial turn
+        await reader
+
+        await save_turn(user_input, ''.join(ai_chunks), memory)
+
+@asynccontextmanager
+async def lifespan(app):
+    app.state.context_messages = await startup()
+    yield
+    await stop_batcher()
+    SESSION.close()
+
+# HTTP chat server, run with: uvicorn AirQualityBot:app (single worker, sessions are per process)
+app = FastAPI(lifespan=lifespan)
+
+class ChatRequest(BaseModel):
+    session_id: str
+    message: str
+
+@app.post('/chat')
+async def chat_endpoint(request: ChatRequest):
+    ai_response = await chat(request.message, get_session(request.session_id), app.state.context_messages)
+    return {'response': ai_response}
+
+@app.post('/chat/stream')
+async def chat_stream_endpoint(request: ChatRequest):
+    ai_chunks = stream_chat(request.message, get_session(request.session_id), app.state.context_messages)
+    return StreamingResponse(ai_chunks, media_type='text/plain')
+
+async def repl():
+    context_messages = await startup()
+    session = get_session('cli')
+    print(context_messages)
+
+    # Start the conversation loop.
+    while True:
+        # Get user input without blocking the event loop.
+        user_input = await asyncio.to_thread(input, "User: ")
+
+        # Check if the user wants to end the conversation.
+        if user_input.lower() == 'quit':
+            break
+
+        # Display the AI response as it is generated.
+        print("AI:", end=" ", flush=True)
+        async for chunk in stream_chat(user_input, session, context_messages):
+            print(chunk, end="", flush=True)
+        print()
+
+def main():
+    try:
+        asyncio.run(repl())
+    finally:
+        SESSION.close()
 
-    # Display the AI response.
-    print("AI:", ai_response)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+import asyncio
+
+import httpx
+import pytest
+
+import AirQualityBot
+from langchain.schema import AIMessage
+from langchain_core.messages import AIMessageChunk
+
+from AirQualityBot import (
+    get_current_air_pollution_data,
+    get_session,
+    invoke_batched,
+    get_pollutant_levels_and_recommendations,
+    load_cached_air_pollution_data,
+    parse_startup_response,
+    save_cached_air_pollution_data,
+    startup,
+    stop_batcher,
+    stream_chat,
+)
+
+
+def make_api_response(*components_list):
+    """Build a minimal OpenWeather response with one data point per components dict."""
+    data_points = []
+    for timestamp, components in enumerate(components_list):
+        pollutants = {'co': 0, 'no2': 0, 'o3': 0, 'so2': 0, 'pm2_5': 0, 'pm10': 0}
+        pollutants.update(components)
+        data_points.append({'dt': timestamp, 'components': pollutants})
+    return {'coord': {'lat': 0, 'lon': 0}, 'list': data_points}
+
+
+def so2_level(value):
+    levels = get_pollutant_levels_and_recommendations(make_api_response({'so2': value}))[0]
+    column = list(levels['Pollutant']).index('so2')
+    return levels['Qualitative Name'][column], levels['Index'][column]
+
+
+@pytest.mark.parametrize('value, expected', [
+    (0, ('Good', 1)),
+    (20, ('Good', 1)),       # upper bound is inclusive
+    (21, ('Fair', 2)),
+    (80, ('Fair', 2)),
+    (350, ('Poor', 4)),
+    (351, ('Very Poor', 5)),
+])
+def test_band_edges(value, expected):
+    assert so2_level(value) == expected
+
+
+def test_gap_value_maps_to_next_band():
+    # 20.5 lies between Good (0-20) and Fair (21-80)
+    assert so2_level(20.5) == ('Fair', 2)
+
+
+def test_value_above_table_is_clamped_to_last_band():
+    assert so2_level(2_000_000) == ('Very Poor', 5)
+
+
+def test_each_data_point_is_matched_separately():
+    levels = get_pollutant_levels_and_recommendations(make_api_response({'co': 0}, {'co': 9401}))
+    column = list(levels[0]['Pollutant']).index('co')
+
+    assert [data_point['Timestamp'] for data_point in levels] == [0, 1]
+    assert levels[0]['Qualitative Name'][column] == 'Good'
+    assert levels[0]['Recommendation'][column] is None
+    assert levels[1]['Qualitative Name'][column] == 'Moderate'
+    assert levels[1]['Recommendation'][column].startswith('People with heart disease')
+
+
+@pytest.mark.parametrize('response', [
+    '{"greeting": "Hi", "recommendations": "Stay in"}',
+    '```json\n{"greeting": "Hi", "recommendations": "Stay in"}\n```',
+    'Here you go:\n{"greeting": "Hi", "recommendations": "Stay in"}',
+])
+def test_parse_startup_response(response):
+    assert parse_startup_response(response) == ('Hi', 'Stay in')
+
+
+@pytest.mark.parametrize('response', [
+    'Good day! Air is fair.',
+    '{"greeting": "Hi"}',
+    '{"greeting": "Hi", "recommendations": ',
+    '["Hi", "Stay in"]',
+])
+def test_parse_startup_response_rejects_unparsable_reply(response):
+    assert parse_startup_response(response) is None
+
+
+@pytest.fixture
+def aq_cache_path(tmp_path, monkeypatch):
+    path = tmp_path / 'aq_cache.json'
+    monkeypatch.setattr(AirQualityBot, 'aq_cache_path', str(path))
+    return path
+
+
+def test_cached_response_is_keyed_on_url(aq_cache_path):
+    save_cached_air_pollution_data('https://example.com/?lat=1', {'list': [1]})
+
+    assert load_cached_air_pollution_data('https://example.com/?lat=1', 900) == {'list': [1]}
+    assert load_cached_air_pollution_data('https://example.com/?lat=2', float('inf')) is None
+
+
+def test_expired_response_is_only_served_without_age_limit(aq_cache_path, monkeypatch):
+    save_cached_air_pollution_data('url', {'list': [1]})
+    monkeypatch.setattr(AirQualityBot.time, 'time', lambda: 1e12)
+
+    assert load_cached_air_pollution_data('url', 900) is None
+    assert load_cached_air_pollution_data('url', float('inf')) == {'list': [1]}
+
+
+@pytest.mark.parametrize('content', [b'not json', b'[]', b'{"data": {}}', b'{"key": 1, "fetched_at": "x"}'])
+def test_malformed_cache_file_is_a_miss(aq_cache_path, content):
+    aq_cache_path.write_bytes(content)
+
+    assert load_cached_air_pollution_data('url', float('inf')) is None
+
+
+@pytest.mark.parametrize('content', [
+    b'<html>Bad gateway</html>',
+    b'[]',
+    b'{"list": [{"dt": 0}]}',
+    b'{"coord": {}, "list": []}',
+    b'{"coord": {}, "list": [{"dt": 0}]}',
+    b'{"coord": {}, "list": [{"components": {"co": 0, "no2": 0, "o3": 0, "so2": 0, "pm2_5": 0, "pm10": 0}}]}',
+    b'{"coord": {}, "list": [{"dt": 0, "components": {"co": 0, "no2": 0, "o3": 0, "so2": 0, "pm2_5": 0}}]}',
+])
+def test_malformed_air_pollution_response_fails_fast(aq_cache_path, monkeypatch, content):
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, content=content))
+    monkeypatch.setattr(AirQualityBot, 'SESSION', httpx.Client(transport=transport))
+    get_current_air_pollution_data.cache_clear()
+
+    with pytest.raises(RuntimeError, match='Malformed response'):
+        get_current_air_pollution_data()
+    assert not aq_cache_path.exists()
+
+
+class FakeStartupLLM:
+    """Answers the batched startup prompt with JSON and the greeting prompt with plain text."""
+
+    def __init__(self):
+        self.prompts = []
+
+    async def ainvoke(self, prompt):
+        self.prompts.append(prompt)
+        if 'Complete the two tasks below' in prompt:
+            return AIMessage(content='```json\n{"greeting": "Hello", "recommendations": "Stay in"}\n```')
+        return AIMessage(content='Hello again')
+
+
+def test_startup_reuses_cached_recommendations_across_measurement_times(tmp_path, monkeypatch):
+    llm = FakeStartupLLM()
+    monkeypatch.setattr(AirQualityBot, 'llm_cache_path', str(tmp_path / 'llm_cache.db'))
+    monkeypatch.setattr(AirQualityBot, 'get_llm', lambda model, temperature: llm)
+
+    for timestamp in (1_700_000_000, 1_700_003_600):
+        api_response = make_api_response({'so2': 100})
+        api_response['list'][0]['dt'] = timestamp
+        monkeypatch.setattr(AirQualityBot, 'get_current_air_pollution_data', lambda: api_response)
+        context_messages = asyncio.run(startup())
+
+    assert len(llm.prompts) == 2
+    assert 'Complete the two tasks below' not in llm.prompts[1]
+    assert context_messages[1].content == 'Hello again Stay in'
+
+
+def test_session_eviction_skips_sessions_answering_a_turn(monkeypatch):
+    monkeypatch.setattr(AirQualityBot, 'sessions', AirQualityBot.OrderedDict())
+    monkeypatch.setattr(AirQualityBot, 'MAX_SESSIONS', 2)
+
+    async def run():
+        busy_memory, busy_lock = get_session('busy')
+        get_session('idle')
+        async with busy_lock:
+            get_session('new')
+        return busy_memory
+
+    busy_memory = asyncio.run(run())
+
+    assert list(AirQualityBot.sessions) == ['busy', 'new']
+    assert get_session('busy')[0] is busy_memory
+
+
+def test_stream_chat_releases_openai_slot_while_caller_is_slow(monkeypatch):
+    class FakeStreamingLLM:
+        async def astream(self, messages):
+            for word in ('Stay', ' ', 'in'):
+                yield AIMessageChunk(content=word)
+
+    # Counting tokens would download the tiktoken encoding
+    monkeypatch.setattr(AirQualityBot.ChatOpenAI, 'get_num_tokens_from_messages', lambda self, messages: 1)
+    monkeypatch.setattr(AirQualityBot, 'sessions', AirQualityBot.OrderedDict())
+
+    async def run():
+        monkeypatch.setattr(AirQualityBot, 'OPENAI_SEMAPHORE', asyncio.Semaphore(1))
+        session = get_session('slow')
+        monkeypatch.setattr(AirQualityBot, 'get_llm', lambda model, temperature: FakeStreamingLLM())
+
+        chunks = stream_chat('Should I go out?', session, [])
+        first_chunk = await chunks.__anext__()
+        await asyncio.sleep(0.01)
+        slot_free = not AirQualityBot.OPENAI_SEMAPHORE.locked()
+        return session, first_chunk + ''.join([chunk async for chunk in chunks]), slot_free
+
+    session, reply, slot_free = asyncio.run(run())
+
+    assert slot_free
+    assert reply == 'Stay in'
+    assert [message.content for message in session[0].chat_memory.messages] == ['Should I go out?', 'Stay in']
+
+
+@pytest.fixture
+def batcher(monkeypatch):
+    """Give each test a fresh batcher and a fake model; returns the sizes of the answered batches."""
+    batch_sizes = []
+    answer_batch = AirQualityBot.answer_batch
+
+    async def recording_answer_batch(batch):
+        batch_sizes.append(len(batch))
+        await answer_batch(batch)
+
+    class FakeChatLLM:
+        async def ainvoke(self, messages):
+            if messages == 'hang':
+                await asyncio.Event().wait()
+            if messages == 'fail':
+                raise ValueError('upstream error')
+            await asyncio.sleep(0.01)
+            return AIMessage(content=f'reply to {messages}')
+
+    monkeypatch.setattr(AirQualityBot, 'pending_requests', None)
+    monkeypatch.setattr(AirQualityBot, 'batcher_task', None)
+    monkeypatch.setattr(AirQualityBot, 'batch_tasks', set())
+    monkeypatch.setattr(AirQualityBot, 'answer_batch', recording_answer_batch)
+    monkeypatch.setattr(AirQualityBot, 'get_llm', lambda model, temperature: FakeChatLLM())
+    return batch_sizes
+
+
+def test_concurrent_requests_are_answered_in_one_batch(batcher):
+    async def run():
+        try:
+            return await asyncio.gather(*(invoke_batched(messages) for messages in ('a', 'b', 'c')))
+        finally:
+            await stop_batcher()
+
+    replies = asyncio.run(run())
+
+    assert [reply.content for reply in replies] == ['reply to a', 'reply to b', 'reply to c']
+    assert batcher == [3]
+
+
+def test_failed_request_only_fails_its_own_caller(batcher):
+    async def run():
+        try:
+            return await asyncio.gather(
+                *(invoke_batched(messages) for messages in ('a', 'fail', 'c')),
+                return_exceptions=True
+            )
+        finally:
+            await stop_batcher()
+
+    first, failed, last = asyncio.run(run())
+
+    assert first.content == 'reply to a'
+    assert isinstance(failed, ValueError)
+    assert last.content == 'reply to c'
+
+
+def test_stop_batcher_fails_in_flight_and_queued_requests(batcher):
+    async def run():
+        in_flight = asyncio.create_task(invoke_batched('hang'))
+        await asyncio.sleep(AirQualityBot.BATCH_WINDOW * 2)
+        queued = asyncio.create_task(invoke_batched('a'))
+        await asyncio.sleep(0)
+
+        await asyncio.wait_for(stop_batcher(), 1)
+        return await asyncio.wait_for(asyncio.gather(in_flight, queued, return_exceptions=True), 1)
+
+    in_flight, queued = asyncio.run(run())
+
+    assert isinstance(in_flight, RuntimeError)
+    assert isinstance(queued, RuntimeError)
+
+
+def test_valid_air_pollution_response_is_cached(aq_cache_path, monkeypatch):
+    api_response = make_api_response({'so2': 100})
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, json=api_response))
+    monkeypatch.setattr(AirQualityBot, 'SESSION', httpx.Client(transport=transport))
+    get_current_air_pollution_data.cache_clear()
+
+    assert get_current_air_pollution_data() == api_response
+    assert aq_cache_path.exists()
+    get_current_air_pollution_data.cache_clear()